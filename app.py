@@ -1,14 +1,29 @@
 import streamlit as st
-from PIL import Image
+from PIL import Image, ImageFilter, ImageStat
 import io
 import base64
 import os
 from dotenv import load_dotenv
 import google.generativeai as genai
 import hashlib
+import fpdf
 from fpdf import FPDF
 import re
 import uuid
+import json
+import html
+import gzip
+import zlib
+import sqlite3
+import contextlib
+import time
+import threading
+import cProfile
+import pstats
+import marshal
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque, OrderedDict
+import numpy as np
 
 # Load environment variables
 load_dotenv()
@@ -30,6 +45,126 @@ if GEMINI_API_KEY:
         generation_config=generation_config,
     )
 
+# Static formatting rules for recipes, sent once as a system instruction
+# instead of being repeated in every prompt
+RECIPE_SYSTEM_INSTRUCTION = """You are a recipe writer. Format every response using plain text only, with NO bullet points, NO asterisks, and NO special formatting.
+
+Structure your response as follows:
+
+[Recipe Title]
+
+INGREDIENTS:
+Ingredient 1 with quantity
+Ingredient 2 with quantity
+...
+
+INSTRUCTIONS:
+1. First step
+2. Second step
+...
+
+For steps, use only numbers followed by a period, never bullet points or asterisks.
+For ingredients, list each on its own line without bullet points or numbers."""
+
+# Maximum estimated input tokens for the per-call part of a recipe prompt
+RECIPE_INPUT_TOKEN_BUDGET = int(os.getenv("RECIPE_INPUT_TOKEN_BUDGET", "400"))
+MAX_INGREDIENT_CHARS = int(os.getenv("MAX_INGREDIENT_CHARS", "40"))
+
+# Near-duplicate recipes in one batch are re-requested with a variation hint
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0.6"))
+DIVERSITY_RETRIES = int(os.getenv("DIVERSITY_RETRIES", "2"))
+
+if GEMINI_API_KEY:
+    recipe_model = genai.GenerativeModel(
+        model_name="gemini-2.0-flash",
+        generation_config=generation_config,
+        system_instruction=RECIPE_SYSTEM_INSTRUCTION,
+    )
+
+# Identification mode: "per_image" sends one request per photo, "batch" packs
+# several downscaled photos into a single request, "progressive" starts at low
+# resolution and escalates only when the result looks incomplete
+IDENTIFY_MODE = os.getenv("IDENTIFY_MODE", "per_image")
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "8"))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(15 * 1024 * 1024)))
+BATCH_MAX_INPUT_TOKENS = int(os.getenv("BATCH_MAX_INPUT_TOKENS", "16000"))
+BATCH_IMAGE_MAX_SIDE = int(os.getenv("BATCH_IMAGE_MAX_SIDE", "768"))
+PROGRESSIVE_SIDES = [int(side) for side in os.getenv("PROGRESSIVE_SIDES", "384,1024").split(",")]
+PROGRESSIVE_MIN_ITEMS = int(os.getenv("PROGRESSIVE_MIN_ITEMS", "3"))
+PROGRESSIVE_CROP_COUNT = int(os.getenv("PROGRESSIVE_CROP_COUNT", "2"))
+OPERATOR_TOOLS = os.getenv("OPERATOR_TOOLS", "0") == "1"
+
+# Deadlines for model calls: a per-call timeout and an overall deadline for
+# requests that make several calls
+MODEL_CALL_TIMEOUT = float(os.getenv("MODEL_CALL_TIMEOUT", "60"))
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "180"))
+
+# Hedged model calls: a duplicate request is sent when a call runs longer
+# than the tracked latency percentile, within a cap on the extra request rate
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.1"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+
+# Reuse of past recipes for similar ingredient sets, found with MinHash
+# signatures and LSH buckets
+RECIPE_REUSE = os.getenv("RECIPE_REUSE", "0") == "1"
+RECIPE_REUSE_THRESHOLD = float(os.getenv("RECIPE_REUSE_THRESHOLD", "0.8"))
+RECIPE_INDEX_SIZE = int(os.getenv("RECIPE_INDEX_SIZE", "1000"))
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+MINHASH_PRIME = (1 << 31) - 1
+
+# Externalised session state, so any replica can resume a session. The sid
+# query parameter is the only credential: anyone with a session's URL can
+# read and change its saved recipes and photos
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_TTL_DAYS = float(os.getenv("SESSION_TTL_DAYS", "30"))
+SESSION_SWEEP_SECONDS = 3600
+PERSISTED_KEYS = ("page", "ingredients", "recipes", "viewing_recipe")
+
+# Per-rerun profiling, enabled with PROFILE_RERUNS=1 or the ?profile=1 query parameter
+PROFILE_RERUNS = os.getenv("PROFILE_RERUNS", "0") == "1"
+PROFILE_HISTORY = int(os.getenv("PROFILE_HISTORY", "20"))
+
+# PDF export: a Unicode TTF font is embedded (as a subset) when one is found
+PDF_FONT_PATH = os.getenv("PDF_FONT_PATH", "")
+PDF_COVER_PAGE = os.getenv("PDF_COVER_PAGE", "0") == "1"
+PDF_FONT_CACHE_DIR = os.getenv("PDF_FONT_CACHE_DIR", "")
+
+# fpdf otherwise writes its parsed font metrics next to the TTF file, which
+# is usually a read-only system font directory
+if PDF_FONT_CACHE_DIR:
+    os.makedirs(PDF_FONT_CACHE_DIR, exist_ok=True)
+    fpdf.set_global("FPDF_CACHE_DIR", PDF_FONT_CACHE_DIR)
+    fpdf.set_global("FPDF_CACHE_MODE", 2)
+else:
+    fpdf.set_global("FPDF_CACHE_MODE", 1)
+UNICODE_FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+]
+
+# Background model calls
+MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", "4"))
+SPECULATIVE_PREFETCH = os.getenv("SPECULATIVE_PREFETCH", "0") == "1"
+PREFETCH_PREFERENCES = ("None", "Any")
+PREFETCH_SETTLE_SECONDS = float(os.getenv("PREFETCH_SETTLE_SECONDS", "3"))
+PIPELINED_IDENTIFY = os.getenv("PIPELINED_IDENTIFY", "0") == "1"
+POLL_SECONDS = float(os.getenv("POLL_SECONDS", "2"))
+STATUS_REFRESH_SECONDS = 0.5
+
+# Generation and identification as per-session background jobs that survive
+# reruns and page switches, on their own pool so they never wait on the
+# model calls queued behind them
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS", "0") == "1"
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_LABELS = {"generate": "Generating recipes", "identify": "Identifying ingredients"}
+
 # Set page config
 st.set_page_config(page_title="Chef's Fridge", layout="wide", page_icon="🍲", initial_sidebar_state="collapsed")
 
@@ -297,25 +432,526 @@ def is_duplicate(new_image, existing_images):
     new_hash = image_hash(new_image)
     return any(image_hash(img) == new_hash for img in existing_images)
 
+def downscale_image(image, max_side=BATCH_IMAGE_MAX_SIDE):
+    """Return an RGB copy of the image whose longest side is at most max_side"""
+    image = image.convert("RGB")
+    if max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side))
+    return image
+
+def estimate_image_tokens(image):
+    """Estimate Gemini input tokens for an image (258 per 768px tile)"""
+    width, height = image.size
+    if width <= 384 and height <= 384:
+        return 258
+    tiles = -(-width // 768) * -(-height // 768)
+    return 258 * tiles
+
+def new_call_stats():
+    return {"requests": 0, "latency": 0.0, "prompt_tokens": 0, "output_tokens": 0, "bytes": 0}
+
+def record_call(stats, started, response=None, sent_bytes=0):
+    """Add one model call (latency, upload size and token usage) to a stats dict"""
+    stats["requests"] += 1
+    stats["bytes"] += sent_bytes
+    stats["latency"] += time.perf_counter() - started
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        stats["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+        stats["output_tokens"] += getattr(usage, "candidates_token_count", 0) or 0
+
+class ModelCallCancelled(Exception):
+    """Raised when a model call is cancelled or its request deadline has passed"""
+
+class CancelToken:
+    """Cancellation flag and deadline shared by the model calls of one request"""
+
+    def __init__(self, deadline=REQUEST_DEADLINE):
+        self._event = threading.Event()
+        self.expires = time.monotonic() + deadline if deadline else None
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def remaining(self):
+        """Seconds left before the deadline, or None if there is no deadline"""
+        return None if self.expires is None else self.expires - time.monotonic()
+
+    def check(self):
+        if self.cancelled:
+            raise ModelCallCancelled("Request was cancelled")
+        if self.expires is not None and self.remaining() <= 0:
+            raise ModelCallCancelled("Request deadline exceeded")
+
+@st.cache_resource
+def get_hedge_state():
+    """Process-wide latency history and hedging metrics, per kind of call"""
+    return {
+        "lock": threading.Lock(),
+        "latencies": {},
+        "calls": 0,
+        "hedges_issued": 0,
+        "hedges_won": 0,
+        "executor": ThreadPoolExecutor(max_workers=MODEL_WORKERS * 2),
+    }
+
+def hedge_delay(state, kind):
+    """Latency percentile after which a call is hedged, or None without enough samples"""
+    with state["lock"]:
+        latencies = sorted(state["latencies"].get(kind, ()))
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    index = min(int(len(latencies) * HEDGE_PERCENTILE / 100), len(latencies) - 1)
+    return latencies[index]
+
+def take_hedge_budget(state):
+    """Reserve one hedge if the extra request rate stays under HEDGE_MAX_RATE"""
+    with state["lock"]:
+        if state["hedges_issued"] + 1 > HEDGE_MAX_RATE * state["calls"]:
+            return False
+        state["hedges_issued"] += 1
+        return True
+
+def start_thread(func, *args):
+    """Run func on a new daemon thread at once, returning a Future for its result"""
+    future = Future()
+
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+def hedged_generate(target, contents, timeout, kind, token=None):
+    """Send a call, duplicating it if it is slower than usual; the first response wins.
+
+    The primary request never waits for a pool thread: it runs on the caller's
+    thread when no hedge is possible, or on a thread of its own so a hedge can
+    still win. Only hedges use the shared pool.
+    """
+    state = get_hedge_state()
+    delay = hedge_delay(state, kind)
+    with state["lock"]:
+        state["calls"] += 1
+
+    def attempt(expires):
+        # A hedge may have waited for a pool thread, so check the token and
+        # fit the timeout to whatever time is left
+        if token is not None:
+            token.check()
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise ModelCallCancelled("Call deadline exceeded")
+        started = time.perf_counter()
+        response = target.generate_content(contents, request_options={"timeout": remaining})
+        with state["lock"]:
+            state["latencies"].setdefault(kind, deque(maxlen=HEDGE_WINDOW)).append(time.perf_counter() - started)
+        return response
+
+    expires = time.monotonic() + timeout
+    if delay is None:
+        return attempt(expires)
+    primary = start_thread(attempt, expires)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+    # Superseded or nearly expired work is not worth paying for twice
+    if token is not None:
+        remaining = token.remaining()
+        if token.cancelled or (remaining is not None and remaining <= 0):
+            return primary.result()
+        if remaining is not None:
+            expires = min(expires, time.monotonic() + remaining)
+    if expires <= time.monotonic() or not take_hedge_budget(state):
+        return primary.result()
+    hedge = state["executor"].submit(attempt, expires)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                # The loser is cancelled if still queued, otherwise its result is dropped
+                for loser in pending:
+                    loser.cancel()
+                if future is hedge:
+                    with state["lock"]:
+                        state["hedges_won"] += 1
+                return future.result()
+            error = future.exception()
+    raise error
+
+def call_model(target, contents, token=None, kind="generate"):
+    """Send one generate_content call, honouring the token and the per-call timeout"""
+    timeout = MODEL_CALL_TIMEOUT
+    if token is not None:
+        token.check()
+        remaining = token.remaining()
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+    if HEDGE_REQUESTS:
+        response = hedged_generate(target, contents, timeout, kind, token)
+    else:
+        response = target.generate_content(contents, request_options={"timeout": timeout})
+    if token is not None and token.cancelled:
+        # The request was superseded while in flight, so its result is unwanted;
+        # the response is kept on the error so callers can still count its cost
+        error = ModelCallCancelled("Request was cancelled")
+        error.response = response
+        raise error
+    return response
+
+def identify_items_per_image(images, token=None):
+    """Identify items with one request per image, returning (items, stats)"""
+    stats = new_call_stats()
+    all_items = []
+    for image in images:
+        data = image_to_bytes(image)
+        base64_image = base64.b64encode(data).decode('utf-8')
+        started = time.perf_counter()
+        response = call_model(model, [
+            "List all food items in this fridge image in a comma-separated format. Be specific and concise.",
+            {"mime_type": "image/jpeg", "data": base64_image}
+        ], token, "identify")
+        record_call(stats, started, response, len(data))
+        items = response.text.split(',')
+        all_items.extend([item.strip() for item in items if item.strip()])
+    return list(set(all_items)), stats
+
+def plan_image_batches(encoded, max_images=BATCH_MAX_IMAGES, max_bytes=BATCH_MAX_BYTES,
+                       max_tokens=BATCH_MAX_INPUT_TOKENS):
+    """Group (data, tokens) pairs into batches that respect the request limits"""
+    batches = []
+    current, current_bytes, current_tokens = [], 0, 0
+    for data, tokens in encoded:
+        too_big = (len(current) >= max_images
+                   or current_bytes + len(data) > max_bytes
+                   or current_tokens + tokens > max_tokens)
+        if current and too_big:
+            batches.append(current)
+            current, current_bytes, current_tokens = [], 0, 0
+        current.append((data, tokens))
+        current_bytes += len(data)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+LIMIT_ERROR_PHRASES = ("request payload size", "payload size", "token count", "too large", "exceeds the maximum")
+
+def parse_batch_items(text, count):
+    """Parse a batched response into one item list per image"""
+    per_image = [[] for _ in range(count)]
+    cleaned = re.sub(r'^```(?:json)?\s*|\s*```$', '', text.strip())
+    try:
+        data = json.loads(cleaned)
+        if isinstance(data, dict):
+            data = data.get("images", [])
+        for position, entry in enumerate(data):
+            # Entries without an image number are matched by their position
+            index = int(entry.get("image", position + 1)) - 1
+            if 0 <= index < count:
+                per_image[index] = [str(item).strip() for item in entry.get("items", []) if str(item).strip()]
+        return per_image
+    except (ValueError, TypeError, AttributeError):
+        pass
+    # Fall back to "Image N: a, b, c" lines
+    for match in re.finditer(r'^\s*image\s*(\d+)\s*[:\-]\s*(.+)$', text, re.IGNORECASE | re.MULTILINE):
+        index = int(match.group(1)) - 1
+        if 0 <= index < count:
+            per_image[index] = [item.strip() for item in match.group(2).split(',') if item.strip()]
+    return per_image
+
+def is_limit_error(error):
+    """Check whether a model error was caused by payload or token limits.
+
+    Only 400 and 413 responses count; quota (429) and timeout (504) errors
+    would fail the same way for a smaller batch.
+    """
+    code = getattr(error, "code", None)
+    if code == 413:
+        return True
+    message = str(error).lower()
+    return code == 400 and any(phrase in message for phrase in LIMIT_ERROR_PHRASES)
+
+def identify_batch(batch, stats, token=None):
+    """Send one batch of encoded images, splitting it in half on limit errors"""
+    contents = [
+        f"You are given {len(batch)} fridge images, numbered 1 to {len(batch)} in order. "
+        "For each image, list all food items in it. Be specific and concise. "
+        'Respond with JSON only, in the form [{"image": 1, "items": ["item", ...]}, ...].'
+    ]
+    for data, _ in batch:
+        contents.append({"mime_type": "image/jpeg", "data": base64.b64encode(data).decode('utf-8')})
+    started = time.perf_counter()
+    try:
+        response = call_model(model, contents, token, "identify_batch")
+    except ModelCallCancelled:
+        raise
+    except Exception as e:
+        if len(batch) > 1 and is_limit_error(e):
+            middle = len(batch) // 2
+            return identify_batch(batch[:middle], stats, token) + identify_batch(batch[middle:], stats, token)
+        raise
+    record_call(stats, started, response, sum(len(data) for data, _ in batch))
+    return parse_batch_items(response.text, len(batch))
+
+def identify_items_batched(images, token=None):
+    """Identify items with several downscaled images per request, returning (items, stats)"""
+    stats = new_call_stats()
+    encoded = []
+    for image in images:
+        small = downscale_image(image)
+        encoded.append((image_to_bytes(small), estimate_image_tokens(small)))
+    all_items = []
+    for batch in plan_image_batches(encoded):
+        for items in identify_batch(batch, stats, token):
+            all_items.extend(items)
+    return list(set(all_items)), stats
+
+def parse_progressive_items(text):
+    """Parse a progressive-pass response into (items, confidence)"""
+    cleaned = re.sub(r'^```(?:json)?\s*|\s*```$', '', text.strip())
+    try:
+        data = json.loads(cleaned)
+        if isinstance(data, list):
+            # A bare list of items without a confidence rating
+            data = {"items": data}
+        items = [str(item).strip() for item in data.get("items", []) if str(item).strip()]
+        return items, str(data.get("confidence", "high")).lower()
+    except (ValueError, TypeError, AttributeError):
+        # Plain comma-separated answer without a confidence rating
+        items = [item.strip().strip('[]{}"\'').strip() for item in cleaned.split(',')]
+        return [item for item in items if item], "high"
+
+def needs_escalation(items, confidence):
+    """Decide whether a pass found too few items or was unsure of them"""
+    return len(items) < PROGRESSIVE_MIN_ITEMS or confidence == "low"
+
+def dense_crops(image, count=PROGRESSIVE_CROP_COUNT):
+    """Return the quadrants of the image with the most edge detail, densest first"""
+    width, height = image.size
+    boxes = [(x, y, x + width // 2, y + height // 2) for y in (0, height // 2) for x in (0, width // 2)]
+    edges = image.convert("L").filter(ImageFilter.FIND_EDGES)
+    boxes.sort(key=lambda box: ImageStat.Stat(edges.crop(box)).mean[0], reverse=True)
+    return [image.crop(box) for box in boxes[:count]]
+
+def identify_rendition(image, stats, token=None):
+    """Send a single rendition of a photo, returning (items, confidence)"""
+    data = image_to_bytes(image)
+    started = time.perf_counter()
+    response = call_model(model, [
+        "List all food items in this fridge image. Be specific and concise. "
+        'Respond with JSON only, in the form {"items": ["item", ...], "confidence": "high|medium|low"}, '
+        "using low confidence when the image is too small or blurry to read reliably.",
+        {"mime_type": "image/jpeg", "data": base64.b64encode(data).decode('utf-8')}
+    ], token, "identify")
+    record_call(stats, started, response, len(data))
+    return parse_progressive_items(response.text)
+
+def identify_image_progressive(image, stats, token=None):
+    """Identify one photo, escalating resolution and then dense crops only when needed"""
+    found = set()
+    for side in PROGRESSIVE_SIDES:
+        items, confidence = identify_rendition(downscale_image(image, side), stats, token)
+        found.update(items)
+        if not needs_escalation(found, confidence):
+            return found
+    for crop in dense_crops(image.convert("RGB")):
+        items, _ = identify_rendition(downscale_image(crop, PROGRESSIVE_SIDES[-1]), stats, token)
+        found.update(items)
+    return found
+
+def identify_items_progressive(images, token=None):
+    """Identify items starting from low-resolution renditions, returning (items, stats)"""
+    stats = new_call_stats()
+    all_items = set()
+    for image in images:
+        all_items.update(identify_image_progressive(image, stats, token))
+    return list(all_items), stats
+
+IDENTIFY_MODES = {
+    "per_image": identify_items_per_image,
+    "batch": identify_items_batched,
+    "progressive": identify_items_progressive,
+}
+
 @st.cache_data
-def identify_items(_images):
+def identify_items(_images, image_keys, mode=IDENTIFY_MODE):
+    """Identify items in the photos, cached by the photos' content hashes (image_keys)"""
     if not GEMINI_API_KEY:
         st.error("Cannot identify items: API key missing.")
         return []
-    all_items = []
-    for image in _images:
-        base64_image = base64.b64encode(image_to_bytes(image)).decode('utf-8')
+    identify = IDENTIFY_MODES.get(mode, identify_items_per_image)
+    try:
+        items, _ = identify(_images, CancelToken())
+    except Exception as e:
+        st.error(f"Error identifying items: {str(e)}")
+        return []
+    return items
+
+def identify_single_image(image, token=None):
+    """Identify one photo with the configured mode, returning cleaned item names"""
+    identify = IDENTIFY_MODES.get(IDENTIFY_MODE, identify_items_per_image)
+    items, _ = identify([image], token)
+    return [re.sub(r'^\s*[-•*]\s*', '', item) for item in items]
+
+def compare_identify_modes(images):
+    """Run every identification mode and return one comparison row per mode"""
+    rows = []
+    for mode, identify in IDENTIFY_MODES.items():
+        started = time.perf_counter()
+        items, stats = identify(images)
+        elapsed = time.perf_counter() - started
+        rows.append({
+            "Mode": mode,
+            "Requests": stats["requests"],
+            "Total latency (s)": round(elapsed, 2),
+            "Latency per image (s)": round(elapsed / max(len(images), 1), 2),
+            "KB per image": round(stats["bytes"] / 1024 / max(len(images), 1), 1),
+            "Prompt tokens": stats["prompt_tokens"],
+            "Output tokens": stats["output_tokens"],
+            "Items found": len(items),
+        })
+    return rows
+
+@st.cache_resource
+def get_model_executor():
+    """Shared worker pool for background model calls"""
+    return ThreadPoolExecutor(max_workers=MODEL_WORKERS)
+
+def queue_image_identification(image):
+    """Start identifying a newly uploaded photo in the background"""
+    if not (PIPELINED_IDENTIFY and GEMINI_API_KEY):
+        return
+    key = image_hash(image)
+    if key in st.session_state.image_jobs or key in st.session_state.image_items:
+        return
+    token = CancelToken()
+    future = get_model_executor().submit(identify_single_image, image.copy(), token)
+    st.session_state.image_jobs[key] = (future, token)
+
+def collect_identification_results():
+    """Merge finished background identifications into the ingredient list"""
+    merged = False
+    for key, (future, _) in list(st.session_state.image_jobs.items()):
+        if not future.done():
+            continue
+        del st.session_state.image_jobs[key]
         try:
-            response = model.generate_content([
-                "List all food items in this fridge image in a comma-separated format. Be specific and concise.",
-                {"mime_type": "image/jpeg", "data": base64_image}
-            ])
-            items = response.text.split(',')
-            all_items.extend([item.strip() for item in items if item.strip()])
+            items = future.result()
+        except ModelCallCancelled:
+            continue
         except Exception as e:
             st.error(f"Error identifying items: {str(e)}")
-            return []
-    return list(set(all_items))
+            continue
+        st.session_state.image_items[key] = items
+        for item in items:
+            if item not in st.session_state.ingredients:
+                st.session_state.ingredients.append(item)
+        merged = True
+    return merged
+
+def retract_image_identification(image):
+    """Remove the ingredients that only a removed photo contributed"""
+    key = image_hash(image)
+    job = st.session_state.image_jobs.pop(key, None)
+    if job:
+        future, token = job
+        future.cancel()
+        token.cancel()
+    items = set(st.session_state.image_items.pop(key, []))
+    still_seen = set()
+    for other_items in st.session_state.image_items.values():
+        still_seen.update(other_items)
+    st.session_state.ingredients = [
+        item for item in st.session_state.ingredients if item not in items or item in still_seen
+    ]
+
+@st.cache_resource
+def get_job_executor():
+    """Shared worker pool for per-session background jobs"""
+    return ThreadPoolExecutor(max_workers=JOB_WORKERS)
+
+def submit_job(name, func, *args):
+    """Run func(*args, token, progress) as the session's job of this kind, superseding any earlier one"""
+    cancel_job(name)
+    job = {"token": CancelToken(), "progress": "Queued...", "started": time.time()}
+    job["future"] = get_job_executor().submit(
+        func, *args, job["token"], lambda message: job.update(progress=message)
+    )
+    st.session_state.jobs[name] = job
+
+def cancel_job(name):
+    job = st.session_state.jobs.pop(name, None)
+    if job:
+        job["future"].cancel()
+        job["token"].cancel()
+
+def identify_job(images, token, progress):
+    """Identify every photo with the configured mode, returning cleaned item names"""
+    progress(f"Scanning {len(images)} photo(s)...")
+    identify = IDENTIFY_MODES.get(IDENTIFY_MODE, identify_items_per_image)
+    items, _ = identify(images, token)
+    return [re.sub(r'^\s*[-•*]\s*', '', item) for item in items]
+
+def collect_job_results():
+    """Write the results of finished background jobs to session state"""
+    collected = False
+    for name, job in list(st.session_state.jobs.items()):
+        if not job["future"].done():
+            continue
+        del st.session_state.jobs[name]
+        collected = True
+        try:
+            result = job["future"].result()
+        except ModelCallCancelled:
+            continue
+        except Exception as e:
+            st.error(f"Error while {JOB_LABELS[name].lower()}: {str(e)}")
+            continue
+        if name == "generate":
+            recipes, stats = result
+            # Failed calls were recorded by the worker, which cannot show errors itself
+            for error in stats.get("errors", []):
+                st.error(f"Error generating recipe: {error}")
+            st.session_state.recipes, st.session_state.recipe_stats = recipes, stats
+        elif name == "identify":
+            # Keep anything the user added or edited while the job ran
+            for item in result:
+                if item not in st.session_state.ingredients:
+                    st.session_state.ingredients.append(item)
+    return collected
+
+@st.fragment(run_every=POLL_SECONDS)
+def poll_identification():
+    """Rerun the app as soon as background identification results arrive"""
+    if collect_identification_results():
+        st.rerun()
+
+@st.fragment(run_every=POLL_SECONDS)
+def show_job_status():
+    """Progress of the session's background jobs, rerunning the app when one finishes"""
+    if any(job["future"].done() for job in st.session_state.jobs.values()):
+        st.rerun()
+    for name, job in list(st.session_state.jobs.items()):
+        elapsed = time.time() - job["started"]
+        cols = st.columns([4, 1])
+        with cols[0]:
+            st.info(f"⏳ {JOB_LABELS[name]}: {job['progress']} ({elapsed:.0f}s)")
+        with cols[1]:
+            if st.button("Cancel", key=f"cancel_job_{name}"):
+                cancel_job(name)
+                st.rerun()
 
 def clean_text(text):
     """Clean recipe text by removing asterisks, bullet points, etc."""
@@ -334,75 +970,447 @@ def clean_text(text):
     
     return text
 
-def generate_recipe(items, diet_preference, cuisine_preference):
+@st.cache_resource
+def get_recipe_index():
+    """Process-wide similarity index of generated recipes, evicted least recently used first"""
+    rng = np.random.default_rng(2024)
+    return {
+        "lock": threading.Lock(),
+        "a": rng.integers(1, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64),
+        "b": rng.integers(0, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64),
+        "entries": OrderedDict(),
+        "buckets": {},
+        "next_id": 0,
+    }
+
+def ingredient_set(items):
+    return frozenset(re.sub(r'\s+', ' ', item).strip().lower() for item in items if item.strip())
+
+def minhash_signature(index, items):
+    """MinHash signature of an ingredient set, one universal hash per permutation"""
+    hashes = np.array(
+        [int.from_bytes(hashlib.md5(item.encode()).digest()[:8], "little") % MINHASH_PRIME for item in items],
+        dtype=np.uint64
+    )
+    return ((np.outer(hashes, index["a"]) + index["b"]) % MINHASH_PRIME).min(axis=0)
+
+def lsh_keys(signature, diet_preference, cuisine_preference):
+    """One bucket key per LSH band, scoped to the diet and cuisine"""
+    rows = len(signature) // LSH_BANDS
+    return [
+        (band, diet_preference, cuisine_preference, signature[band * rows:(band + 1) * rows].tobytes())
+        for band in range(LSH_BANDS)
+    ]
+
+def index_recipe(items, diet_preference, cuisine_preference, recipe):
+    """Add a generated recipe to the similarity index"""
+    items = ingredient_set(items)
+    if not (RECIPE_REUSE and items):
+        return
+    index = get_recipe_index()
+    keys = lsh_keys(minhash_signature(index, items), diet_preference, cuisine_preference)
+    with index["lock"]:
+        entry_id = index["next_id"]
+        index["next_id"] += 1
+        index["entries"][entry_id] = {"items": items, "recipe": recipe, "keys": keys}
+        for key in keys:
+            index["buckets"].setdefault(key, set()).add(entry_id)
+        while len(index["entries"]) > RECIPE_INDEX_SIZE:
+            old_id, old_entry = index["entries"].popitem(last=False)
+            for key in old_entry["keys"]:
+                bucket = index["buckets"][key]
+                bucket.discard(old_id)
+                if not bucket:
+                    del index["buckets"][key]
+
+def find_similar_recipes(items, diet_preference, cuisine_preference, limit):
+    """Return up to limit stored recipes whose ingredients are within the Jaccard threshold"""
+    items = ingredient_set(items)
+    if not (RECIPE_REUSE and items and limit > 0):
+        return []
+    index = get_recipe_index()
+    keys = lsh_keys(minhash_signature(index, items), diet_preference, cuisine_preference)
+    with index["lock"]:
+        candidates = set()
+        for key in keys:
+            candidates.update(index["buckets"].get(key, ()))
+        # LSH only proposes candidates; the exact Jaccard similarity decides
+        scored = []
+        for entry_id in candidates:
+            stored = index["entries"][entry_id]["items"]
+            similarity = len(items & stored) / len(items | stored)
+            if similarity >= RECIPE_REUSE_THRESHOLD:
+                scored.append((similarity, entry_id))
+        scored.sort(reverse=True)
+        matches = []
+        for _, entry_id in scored[:limit]:
+            index["entries"].move_to_end(entry_id)
+            matches.append(index["entries"][entry_id]["recipe"])
+    return matches
+
+def estimate_tokens(text):
+    """Roughly estimate the token count of a text (about 4 characters per token)"""
+    return len(text) // 4 + 1
+
+def compact_ingredients(items):
+    """Normalise whitespace, shorten long entries and drop case-insensitive duplicates"""
+    seen = set()
+    compacted = []
+    for item in items:
+        item = re.sub(r'\s+', ' ', item).strip()[:MAX_INGREDIENT_CHARS].strip()
+        if item and item.lower() not in seen:
+            seen.add(item.lower())
+            compacted.append(item)
+    return compacted
+
+def build_recipe_prompt(items, diet_preference, cuisine_preference, budget=RECIPE_INPUT_TOKEN_BUDGET, avoid=None):
+    """Build the per-call recipe prompt within the token budget, returning (prompt, dropped)"""
+    diet_instruction = f"The recipe should be {diet_preference.lower()}." if diet_preference != "None" else ""
+    cuisine_instruction = f"The recipe should be {cuisine_preference} cuisine." if cuisine_preference != "Any" else ""
+    variation_hint = (f"Make it a clearly different dish from these recipes: {'; '.join(avoid)}."
+                      if avoid else "")
+    items = compact_ingredients(items)
+    dropped = 0
+    while True:
+        prompt = " ".join(filter(None, [
+            f"Create a recipe using these ingredients: {', '.join(items)}.",
+            diet_instruction,
+            cuisine_instruction,
+            variation_hint
+        ]))
+        # Ingredients are kept in the user's order, so the last ones are dropped first
+        if estimate_tokens(prompt) <= budget or len(items) <= 1:
+            return prompt, dropped
+        items = items[:-1]
+        dropped += 1
+
+def generate_recipe(items, diet_preference, cuisine_preference, stats=None, token=None, avoid=None):
     if not GEMINI_API_KEY:
         return "API key missing. Please configure it to generate recipes."
     try:
-        diet_instruction = f"The recipe should be {diet_preference.lower()}." if diet_preference != "None" else ""
-        cuisine_instruction = f"The recipe should be {cuisine_preference} cuisine." if cuisine_preference != "Any" else ""
-        prompt = f"""Create a recipe using these ingredients: {', '.join(items)}. {diet_instruction} {cuisine_instruction} 
-        
-        IMPORTANT: Format your response using plain text only, with NO bullet points, NO asterisks, and NO special formatting.
-        
-        Structure your response as follows:
-        
-        [Recipe Title]
-        
-        INGREDIENTS:
-        Ingredient 1 with quantity
-        Ingredient 2 with quantity
-        ...
-        
-        INSTRUCTIONS:
-        1. First step
-        2. Second step
-        ...
-        
-        For steps, use only numbers followed by a period, never bullet points or asterisks.
-        For ingredients, list each on its own line without bullet points or numbers.
-        """
+        prompt, dropped = build_recipe_prompt(items, diet_preference, cuisine_preference, avoid=avoid)
         
-        response = model.generate_content(prompt)
+        started = time.perf_counter()
+        response = call_model(recipe_model, prompt, token, "generate")
+        if stats is not None:
+            record_call(stats, started, response)
+            stats["dropped_items"] = max(stats.get("dropped_items", 0), dropped)
         recipe_text = response.text
         
         # Clean up formatting
         recipe_text = clean_text(recipe_text)
         
+        index_recipe(items, diet_preference, cuisine_preference, recipe_text)
         return recipe_text
+    except ModelCallCancelled as e:
+        # Superseded or past its deadline, so there is no recipe to show, but
+        # a call that already returned was still paid for
+        if stats is not None and getattr(e, "response", None) is not None:
+            record_call(stats, started, e.response)
+        return None
     except Exception as e:
-        st.error(f"Error generating recipe: {str(e)}")
-        return "Unable to generate recipe."
+        if stats is None:
+            st.error(f"Error generating recipe: {str(e)}")
+        else:
+            # Reported by the caller, which may be running on another thread
+            stats.setdefault("errors", []).append(str(e))
+        return None
+
+def wait_with_status(future, status_text, status):
+    """Wait for work running off the script thread, refreshing its status text.
+
+    Each refresh gives Streamlit a chance to stop this run when the user
+    changes something, instead of blocking until the work is done.
+    """
+    started = time.monotonic()
+    while not wait([future], timeout=STATUS_REFRESH_SECONDS).done:
+        status_text.text(f"{status['message']} ({time.monotonic() - started:.0f}s)")
+    status_text.empty()
+    return future.result()
 
-def generate_multiple_recipes(items, diet_preference, cuisine_preference, num_recipes):
-    """Generate multiple recipes with a simplified progress indicator"""
+def generate_multiple_recipes(items, diet_preference, cuisine_preference, num_recipes, stats=None, token=None,
+                              progress=None):
+    """Generate multiple recipes, reporting progress through an optional callback"""
     results = []
     
-    # Show a text status instead of using the progress bar
-    status_text = st.empty()
-    
     for i in range(num_recipes):
-        status_text.text(f"Generating recipe {i+1} of {num_recipes}...")
-        recipe = generate_recipe(items, diet_preference, cuisine_preference)
-        results.append(recipe)
+        if token is not None and token.cancelled:
+            break
+        if progress is not None:
+            progress(f"Generating recipe {i+1} of {num_recipes}...")
+        recipe = generate_recipe(items, diet_preference, cuisine_preference, stats, token)
+        if recipe is not None:
+            results.append(recipe)
         
-    status_text.empty()
     return results
 
-def get_pdf_download_link(recipes, filename="recipes"):
+def new_prefetch_stats():
+    return {"started": 0, "hits": 0, "discarded": 0, "wasted_requests": 0, "wasted_tokens": 0}
+
+def start_recipe_prefetch(ingredients, settled=False):
+    """Start generating a default-preference recipe in the background.
+
+    The call is only made once the ingredient list has stayed the same for
+    PREFETCH_SETTLE_SECONDS, or at once when settled is True.
+    """
+    if not (SPECULATIVE_PREFETCH and GEMINI_API_KEY and ingredients):
+        return
+    key = tuple(ingredients)
+    prefetch = st.session_state.prefetch
+    if prefetch and prefetch["key"] == key:
+        return
+    discard_prefetch()
+    pending = st.session_state.prefetch_pending
+    if not settled:
+        if not pending or pending["key"] != key:
+            st.session_state.prefetch_pending = {"key": key, "since": time.monotonic()}
+            return
+        if time.monotonic() - pending["since"] < PREFETCH_SETTLE_SECONDS:
+            return
+    st.session_state.prefetch_pending = None
+    stats = new_call_stats()
+    token = CancelToken()
+    future = get_model_executor().submit(generate_recipe, list(ingredients), *PREFETCH_PREFERENCES, stats, token)
+    st.session_state.prefetch = {"key": key, "future": future, "stats": stats, "token": token}
+    st.session_state.prefetch_stats["started"] += 1
+
+@st.fragment(run_every=POLL_SECONDS)
+def settle_prefetch():
+    """Start the pending prefetch once the ingredient list has stopped changing"""
+    start_recipe_prefetch(st.session_state.ingredients)
+
+def discard_prefetch():
+    """Cancel the pending prefetch, counting its spend as wasted if it already ran"""
+    prefetch = st.session_state.prefetch
+    if not prefetch:
+        return
+    st.session_state.prefetch = None
+    metrics = st.session_state.prefetch_stats
+    metrics["discarded"] += 1
+    prefetch["token"].cancel()
+    if not prefetch["future"].cancel():
+        def count_waste(_):
+            stats = prefetch["stats"]
+            metrics["wasted_requests"] += stats["requests"]
+            metrics["wasted_tokens"] += stats["prompt_tokens"] + stats["output_tokens"]
+        prefetch["future"].add_done_callback(count_waste)
+
+def claim_prefetch(ingredients, diet_preference, cuisine_preference):
+    """Take the session's prefetch if it matches the request, otherwise None"""
+    prefetch = st.session_state.prefetch
+    if not prefetch or prefetch["key"] != tuple(ingredients):
+        return None
+    if (diet_preference, cuisine_preference) != PREFETCH_PREFERENCES:
+        return None
+    st.session_state.prefetch = None
+    prefetch["metrics"] = st.session_state.prefetch_stats
+    return prefetch
+
+def take_prefetched_recipe(prefetch, stats):
+    """Wait for a claimed prefetch and return its recipe, or None if it failed"""
+    recipe = prefetch["future"].result()
+    for field in ("requests", "latency", "prompt_tokens", "output_tokens"):
+        stats[field] += prefetch["stats"][field]
+    if recipe is None or prefetch["stats"]["requests"] == 0:
+        # The background call failed, so generate normally instead
+        return None
+    prefetch["metrics"]["hits"] += 1
+    return recipe
+
+def recipe_title(recipe_text):
+    title_match = re.search(r'^(.+?)(?:\n|$)', recipe_text.strip())
+    return title_match.group(1) if title_match else ""
+
+def shingles(text, size=3):
+    """Word shingles of a text, or its single words when it is shorter than size"""
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    if len(words) < size:
+        return set(words)
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def recipe_profile(recipe_text):
+    """Title, ingredient and step shingles used to compare recipes"""
+    return (
+        shingles(recipe_title(recipe_text), 1),
+        shingles(" ".join(parse_recipe_ingredients(recipe_text))),
+        shingles(" ".join(parse_recipe_steps(recipe_text))),
+    )
+
+def recipe_similarity(profile, other):
+    """Weighted Jaccard similarity of two recipe profiles (title 20%, ingredients and steps 40% each)"""
+    total = 0
+    for weight, a, b in zip((0.2, 0.4, 0.4), profile, other):
+        if a or b:
+            total += weight * len(a & b) / len(a | b)
+        else:
+            total += weight
+    return total
+
+def find_duplicate_recipes(recipes):
+    """Indexes of recipes that nearly duplicate an earlier recipe in the batch"""
+    profiles = [recipe_profile(recipe) for recipe in recipes]
+    return [
+        i for i in range(1, len(recipes))
+        if any(recipe_similarity(profiles[i], profiles[j]) >= DUPLICATE_THRESHOLD for j in range(i))
+    ]
+
+def diversify_recipes(recipes, items, diet_preference, cuisine_preference, stats, token=None):
+    """Re-request only near-duplicate recipes with a variation hint, within DIVERSITY_RETRIES"""
+    stats["wasted_calls"] = 0
+    stats["saved_calls"] = 0
+    retries = DIVERSITY_RETRIES
+    duplicates = find_duplicate_recipes(recipes)
+    while duplicates and retries > 0:
+        regenerate = duplicates[:retries]
+        retries -= len(regenerate)
+        # Each duplicate was a paid call; regenerating only those saves the rest of the batch
+        stats["wasted_calls"] += len(regenerate)
+        stats["saved_calls"] += len(recipes) - len(regenerate)
+        for index in regenerate:
+            avoid = list(dict.fromkeys(recipe_title(recipe) for k, recipe in enumerate(recipes) if k != index))
+            if token is not None and token.cancelled:
+                break
+            recipe = generate_recipe(items, diet_preference, cuisine_preference, stats, token, avoid)
+            if recipe is not None:
+                recipes[index] = recipe
+        duplicates = find_duplicate_recipes(recipes)
+    stats["remaining_duplicates"] = len(duplicates)
+    return recipes
+
+def build_recipes(ingredients, diet_preference, cuisine_preference, num_recipes, reused, prefetch,
+                  token, progress=None):
+    """Complete a batch of recipes from reused ones, a claimed prefetch and new calls"""
+    stats = new_call_stats()
+    recipes = list(reused)
+    stats["reused"] = len(recipes)
+    if prefetch and len(recipes) < num_recipes:
+        prefetched = take_prefetched_recipe(prefetch, stats)
+        if prefetched:
+            recipes.append(prefetched)
+    recipes += generate_multiple_recipes(
+        ingredients,
+        diet_preference,
+        cuisine_preference,
+        num_recipes - len(recipes),
+        stats,
+        token,
+        progress
+    )
+    if progress is not None:
+        progress("Checking the recipes for near-duplicates...")
+    recipes = diversify_recipes(recipes, ingredients, diet_preference, cuisine_preference, stats, token)
+    return recipes, stats
+
+def create_recipes(diet_preference, cuisine_preference, num_recipes, reuse=True, background=False):
+    """Fill the session's recipes from similar past recipes, the prefetch and new calls"""
+    # Session state is only read here, so the batch itself can run off the script thread
+    ingredients = list(st.session_state.ingredients)
+    reused = []
+    if reuse:
+        reused = find_similar_recipes(ingredients, diet_preference, cuisine_preference, num_recipes)
+    prefetch = None
+    if len(reused) < num_recipes:
+        prefetch = claim_prefetch(ingredients, diet_preference, cuisine_preference)
+    args = (ingredients, diet_preference, cuisine_preference, num_recipes, reused, prefetch)
+    if background:
+        submit_job("generate", build_recipes, *args)
+        return
+    token = CancelToken()
+    st.session_state.generation = {"token": token, "key": (diet_preference, cuisine_preference)}
+    # The batch gets a thread of its own rather than a place in a shared pool,
+    # so concurrent sessions never queue behind each other's calls
+    status = {"message": "Creating your recipes..."}
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        future = executor.submit(build_recipes, *args, token, lambda message: status.update(message=message))
+        recipes, stats = wait_with_status(future, st.empty(), status)
+    finally:
+        # Also runs when Streamlit stops this run for a newer one, so the
+        # remaining calls are skipped and in-flight results are dropped
+        executor.shutdown(wait=False)
+        cancel_generation()
+    for error in stats.get("errors", []):
+        st.error(f"Error generating recipe: {error}")
+    st.session_state.recipes = recipes
+    st.session_state.recipe_stats = stats
+
+def cancel_generation(key=None):
+    """Cancel the foreground generation, or only one started for other preferences than key"""
+    generation = st.session_state.generation
+    if generation and (key is None or generation["key"] != key):
+        generation["token"].cancel()
+        st.session_state.generation = None
+
+def find_unicode_font():
+    """Path of a Unicode TTF font for PDFs, or None to fall back to core fonts"""
+    candidates = [PDF_FONT_PATH] if PDF_FONT_PATH else []
+    candidates += UNICODE_FONT_CANDIDATES
+    return next((path for path in candidates if os.path.exists(path)), None)
+
+def font_variant(path, style):
+    """Bold or italic file next to a font (DejaVuSans.ttf -> DejaVuSans-Bold.ttf), or None"""
+    base, ext = os.path.splitext(path)
+    variant = f"{base}-{style}{ext}"
+    return variant if os.path.exists(variant) else None
+
+def fits_latin1(text):
+    try:
+        text.encode("latin-1")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+def render_recipes_pdf(recipes, unicode=None, branded=PDF_COVER_PAGE):
+    """Render recipes to PDF bytes.
+
+    Core Arial adds no font data, so it is used whenever all text fits in
+    Latin-1. Otherwise (or with unicode=True) only the glyphs used from a
+    Unicode TTF font are embedded. Without a Unicode font, or with
+    unicode=False, characters outside Latin-1 are dropped. The author cover
+    page and page footers are only added when branded.
+    """
+    if unicode is None:
+        unicode = not all(fits_latin1(recipe) for recipe in recipes)
+    font_path = find_unicode_font() if unicode else None
     pdf = FPDF()
+    pdf.set_compression(True)
     pdf.set_auto_page_break(auto=True, margin=15)
     
+    bold, italic = 'B', 'I'
+    if font_path:
+        family = "Recipe"
+        pdf.add_font(family, "", font_path, uni=True)
+        # Missing variants reuse the regular font rather than embedding it twice
+        for style, suffix in (('B', "Bold"), ('I', "Oblique")):
+            variant = font_variant(font_path, suffix)
+            if variant:
+                pdf.add_font(family, style, variant, uni=True)
+        bold = 'B' if font_variant(font_path, "Bold") else ''
+        italic = 'I' if font_variant(font_path, "Oblique") else ''
+        char_widths = pdf.fonts["recipe"]["cw"]
+        
+        # Drop characters the font has no glyph for, such as emojis
+        def text(value):
+            return "".join(c for c in value if c in "\n\t" or (ord(c) < len(char_widths) and char_widths[ord(c)]))
+    else:
+        family = "Arial"
+        
+        # Core fonts only cover Latin-1
+        def text(value):
+            return value.encode("latin-1", errors="ignore").decode("latin-1")
+    
     # Add author information to the first page
-    pdf.add_page()
-    pdf.set_font("Arial", 'B', 16)
-    pdf.cell(0, 10, "Chef's Fridge", ln=True, align="C")
-    pdf.set_font("Arial", size=12)
-    pdf.cell(0, 10, "Created by Hrishikesh Khandade", ln=True, align="C")
-    pdf.cell(0, 10, "Contact: khandadehrishikesh@gmail.com", ln=True, align="C")
-    pdf.ln(10)
-    pdf.set_font("Arial", 'I', 10)
-    pdf.cell(0, 10, "This project was developed as part of academic research", ln=True, align="C")
-    pdf.ln(10)
+    if branded:
+        pdf.add_page()
+        pdf.set_font(family, bold, 16)
+        pdf.cell(0, 10, "Chef's Fridge", ln=True, align="C")
+        pdf.set_font(family, size=12)
+        pdf.cell(0, 10, "Created by Hrishikesh Khandade", ln=True, align="C")
+        pdf.cell(0, 10, "Contact: khandadehrishikesh@gmail.com", ln=True, align="C")
+        pdf.ln(10)
+        pdf.set_font(family, italic, 10)
+        pdf.cell(0, 10, "This project was developed as part of academic research", ln=True, align="C")
+        pdf.ln(10)
     
     for i, recipe in enumerate(recipes, 1):
         pdf.add_page()
@@ -415,25 +1423,108 @@ def get_pdf_download_link(recipes, filename="recipes"):
         title = title_match.group(1) if title_match else f"Recipe {i}"
         
         # Add title
-        pdf.set_font("Arial", 'B', 16)
-        pdf.cell(0, 15, txt=title, ln=True, align="C")
+        pdf.set_font(family, bold, 16)
+        pdf.cell(0, 15, txt=text(title), ln=True, align="C")
         
         # Add content with better formatting
-        pdf.set_font("Arial", size=12)
-        pdf.multi_cell(0, 10, txt=recipe.replace(title, "").strip())
+        pdf.set_font(family, size=12)
+        pdf.multi_cell(0, 10, txt=text(recipe.replace(title, "").strip()))
         
     # Add footer with author information on each page
-    pdf.set_auto_page_break(False)
-    for page in range(1, pdf.page_no() + 1):
-        pdf.page = page
-        pdf.set_y(-15)
-        pdf.set_font("Arial", 'I', 8)
-        pdf.cell(0, 10, f"Created by Hrishikesh Khandade | Page {page}", 0, 0, 'C')
-    
-    pdf_output = pdf.output(dest="S").encode("latin-1", errors="ignore")
+    if branded:
+        pdf.set_auto_page_break(False)
+        for page in range(1, pdf.page_no() + 1):
+            pdf.page = page
+            pdf.set_y(-15)
+            pdf.set_font(family, italic, 8)
+            pdf.cell(0, 10, f"Created by Hrishikesh Khandade | Page {page}", 0, 0, 'C')
+    
+    # Unicode fonts are already encoded as bytes within the string
+    return pdf.output(dest="S").encode("latin-1")
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_recipes_pdf(recipes):
+    return render_recipes_pdf(recipes)
+
+def get_pdf_download_link(recipes, filename="recipes"):
+    pdf_output = build_recipes_pdf(list(recipes))
     b64 = base64.b64encode(pdf_output).decode()
     
-    return f'<a href="data:application/pdf;base64,{b64}" download="{filename}.pdf" class="download-btn">Download PDF</a>'
+    return f'<a href="data:application/pdf;base64,{b64}" download="{html.escape(filename)}.pdf" class="download-btn">Download PDF</a>'
+
+def benchmark_pdf_backends(recipes, runs=3):
+    """Compare size and render time of the core-font and Unicode-subset PDF backends"""
+    rows = []
+    for backend, unicode in (("Core font", False), ("Unicode subset", True), ("Default (auto)", None)):
+        started = time.perf_counter()
+        for _ in range(runs):
+            # Same cover page and footers for all, so only the font differs
+            data = render_recipes_pdf(recipes, unicode, PDF_COVER_PAGE)
+        rows.append({
+            "Backend": backend,
+            "Size (KB)": round(len(data) / 1024, 1),
+            "Time (ms)": round((time.perf_counter() - started) / runs * 1000, 1),
+        })
+    return rows
+
+RECIPE_FIELDS = ("id", "title", "content", "ingredients", "diet", "cuisine")
+GZIP_MAGIC = b"\x1f\x8b"
+
+def export_saved_recipes(recipes, fileobj, compress=True):
+    """Write saved recipes to a binary file as JSON Lines, one record at a time"""
+    out = gzip.GzipFile(fileobj=fileobj, mode="wb") if compress else fileobj
+    count = 0
+    for recipe in recipes:
+        record = {field: recipe[field] for field in RECIPE_FIELDS}
+        out.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+        count += 1
+    if compress:
+        out.close()
+    return count
+
+def iter_imported_recipes(fileobj):
+    """Yield valid recipe records from a (possibly gzip-compressed) JSON Lines file"""
+    if fileobj.read(2) == GZIP_MAGIC:
+        fileobj.seek(0)
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode="rb")
+    else:
+        fileobj.seek(0)
+    for line in fileobj:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if is_valid_recipe_record(record):
+            yield {field: record[field] for field in RECIPE_FIELDS}
+
+def is_valid_recipe_record(record):
+    """Check that an imported record has every field, with the types the app expects"""
+    if not isinstance(record, dict) or not all(field in record for field in RECIPE_FIELDS):
+        return False
+    if not all(isinstance(record[field], str) for field in RECIPE_FIELDS if field != "ingredients"):
+        return False
+    return isinstance(record["ingredients"], list) and all(isinstance(item, str) for item in record["ingredients"])
+
+def import_saved_recipes(fileobj, saved_recipes):
+    """Append imported recipes that are not already saved.
+
+    Returns (added, error): recipes read before a truncated or corrupt file
+    is detected are kept, and error describes the problem.
+    """
+    known_ids = {recipe['id'] for recipe in saved_recipes}
+    added = 0
+    try:
+        for record in iter_imported_recipes(fileobj):
+            if record['id'] not in known_ids:
+                known_ids.add(record['id'])
+                saved_recipes.append(record)
+                added += 1
+    except (gzip.BadGzipFile, EOFError, UnicodeDecodeError, zlib.error) as e:
+        return added, str(e) or type(e).__name__
+    return added, None
 
 def parse_recipe_steps(recipe_text):
     """Extract steps from recipe text"""
@@ -510,6 +1601,328 @@ def parse_recipe_ingredients(recipe_text):
     
     return ingredients
 
+@st.cache_data(max_entries=256, show_spinner=False)
+def render_ingredients_html(recipe_text):
+    """Render a recipe's ingredients as one HTML fragment, or None if none are found"""
+    ingredients = parse_recipe_ingredients(recipe_text)
+    if not ingredients:
+        return None
+    # Clean any bullet points in the ingredients
+    ingredients = [html.escape(re.sub(r'^\s*[•\-*]\s+', '', ingredient)) for ingredient in ingredients]
+    items = "".join(
+        '<div class="ingredient-list-item"><span class="ingredient-bullet">•</span>'
+        f"<span>{ingredient}</span></div>"
+        for ingredient in ingredients
+    )
+    return f"<div style='margin-top: 10px;'>{items}</div>"
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def render_steps_html(recipe_text):
+    """Render a recipe's numbered steps as one HTML fragment, or None if none are found"""
+    steps = parse_recipe_steps(recipe_text)
+    if not steps:
+        return None
+    # Ensure no bullet points in the step text
+    steps = [html.escape(re.sub(r'^\s*[•\-*]\s+', '', step)) for step in steps]
+    items = "".join(
+        f'<div class="step-card"><span class="step-number">{number}</span>'
+        f"<span>{step}</span></div>"
+        for number, step in enumerate(steps, 1)
+    )
+    return f"<div style='margin-top: 10px;'>{items}</div>"
+
+class SessionStore:
+    """Storage for serialised session state and content-addressed blobs"""
+
+    def load(self, session_id):
+        raise NotImplementedError
+
+    def save(self, session_id, data, blob_keys=()):
+        """Save a session along with the keys of the blobs it references"""
+        raise NotImplementedError
+
+    def load_recipes(self, session_id):
+        """Serialised saved recipes of a session, in the order they were added"""
+        raise NotImplementedError
+
+    def add_recipes(self, session_id, recipes):
+        """Append (recipe id, serialised recipe) pairs to a session's saved recipes"""
+        raise NotImplementedError
+
+    def delete_recipes(self, session_id, recipe_ids):
+        raise NotImplementedError
+
+    def load_blob(self, key):
+        raise NotImplementedError
+
+    def save_blob(self, key, data):
+        raise NotImplementedError
+
+class SQLiteSessionStore(SessionStore):
+    """Session store in a local SQLite file, standing in for a shared store.
+
+    Sessions not saved for SESSION_TTL_DAYS are swept, along with their saved
+    recipes and the blobs no remaining session references, at most once per SESSION_SWEEP_SECONDS.
+    """
+
+    def __init__(self, path, ttl=SESSION_TTL_DAYS * 86400):
+        self.path = path
+        self.ttl = ttl
+        self.last_sweep = 0.0
+        self.sweep_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB, updated REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS blobs (key TEXT PRIMARY KEY, data BLOB, created REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS session_blobs (session_id TEXT, key TEXT, "
+                         "PRIMARY KEY (session_id, key))")
+            # One row per saved recipe, so saving a recipe does not rewrite the whole library
+            conn.execute("CREATE TABLE IF NOT EXISTS saved_recipes (session_id TEXT, id TEXT, data BLOB, "
+                         "PRIMARY KEY (session_id, id))")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """A connection that commits on success and is always closed"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def load(self, session_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def save(self, session_id, data, blob_keys=()):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions (id, data, updated) VALUES (?, ?, ?)",
+                         (session_id, data, time.time()))
+            conn.execute("DELETE FROM session_blobs WHERE session_id = ?", (session_id,))
+            conn.executemany("INSERT OR IGNORE INTO session_blobs (session_id, key) VALUES (?, ?)",
+                             [(session_id, key) for key in blob_keys])
+        self.maybe_sweep()
+
+    def load_recipes(self, session_id):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT data FROM saved_recipes WHERE session_id = ? ORDER BY rowid",
+                                (session_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def add_recipes(self, session_id, recipes):
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO saved_recipes (session_id, id, data) VALUES (?, ?, ?)",
+                             [(session_id, recipe_id, data) for recipe_id, data in recipes])
+            conn.execute("UPDATE sessions SET updated = ? WHERE id = ?", (time.time(), session_id))
+
+    def delete_recipes(self, session_id, recipe_ids):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM saved_recipes WHERE session_id = ? AND id = ?",
+                             [(session_id, recipe_id) for recipe_id in recipe_ids])
+            conn.execute("UPDATE sessions SET updated = ? WHERE id = ?", (time.time(), session_id))
+
+    def load_blob(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM blobs WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def save_blob(self, key, data):
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO blobs (key, data, created) VALUES (?, ?, ?)",
+                         (key, data, time.time()))
+
+    def maybe_sweep(self):
+        """Sweep if the last sweep was more than SESSION_SWEEP_SECONDS ago"""
+        with self.sweep_lock:
+            if time.time() - self.last_sweep < SESSION_SWEEP_SECONDS:
+                return
+            self.last_sweep = time.time()
+        self.sweep()
+
+    def sweep(self):
+        """Delete expired sessions, their saved recipes and unreferenced blobs.
+
+        Returns how many sessions and blobs were deleted.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            sessions = conn.execute("DELETE FROM sessions WHERE updated < ?", (now - self.ttl,)).rowcount
+            conn.execute("DELETE FROM session_blobs WHERE session_id NOT IN (SELECT id FROM sessions)")
+            conn.execute("DELETE FROM saved_recipes WHERE session_id NOT IN (SELECT id FROM sessions)")
+            # Fresh blobs are kept, since their session may not have been saved yet
+            blobs = conn.execute(
+                "DELETE FROM blobs WHERE created < ? AND key NOT IN (SELECT key FROM session_blobs)",
+                (now - SESSION_SWEEP_SECONDS,)
+            ).rowcount
+        return sessions, blobs
+
+SESSION_STORES = {
+    "sqlite": lambda: SQLiteSessionStore(SESSION_DB_PATH),
+}
+
+@st.cache_resource
+def get_session_store():
+    """The configured session store, or None to keep state in-process only"""
+    factory = SESSION_STORES.get(SESSION_BACKEND)
+    return factory() if factory else None
+
+def encode_session_state(state):
+    return zlib.compress(json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+def decode_session_state(data):
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+def restore_session():
+    """On the first run of a browser session, load its state from the session store"""
+    store = get_session_store()
+    if store is None or st.session_state.session_id:
+        return
+    session_id = st.query_params.get("sid")
+    if not session_id:
+        # New session: its id travels in the URL so any replica can resume it
+        session_id = uuid.uuid4().hex
+        st.query_params["sid"] = session_id
+    st.session_state.session_id = session_id
+    data = store.load(session_id)
+    if data is None:
+        return
+    state = decode_session_state(data)
+    for key in PERSISTED_KEYS:
+        if key in state:
+            st.session_state[key] = state[key]
+    images = []
+    blob_keys = {}
+    for key in state.get("images", []):
+        blob = store.load_blob(key)
+        if blob is not None:
+            image = Image.open(io.BytesIO(blob))
+            images.append(image)
+            blob_keys[id(image)] = key
+    st.session_state.images = images
+    st.session_state.blob_keys = blob_keys
+    st.session_state.persisted_digest = hashlib.md5(data).hexdigest()
+    saved_recipes = [json.loads(recipe) for recipe in store.load_recipes(session_id)]
+    st.session_state.saved_recipes = saved_recipes
+    st.session_state.persisted_recipes = {
+        "signature": (id(saved_recipes), len(saved_recipes)),
+        "ids": [recipe["id"] for recipe in saved_recipes],
+    }
+
+def persist_session():
+    """Save the session's state to the session store if it changed during this run"""
+    store = get_session_store()
+    if store is None or not st.session_state.get("session_id"):
+        return
+    # Images are stored once by content hash; the session only lists their keys
+    known = st.session_state.blob_keys
+    blob_keys = {}
+    for image in st.session_state.images:
+        key = known.get(id(image))
+        if key is None:
+            blob = image_to_bytes(image.convert("RGB"))
+            key = hashlib.sha256(blob).hexdigest()
+            store.save_blob(key, blob)
+        blob_keys[id(image)] = key
+    st.session_state.blob_keys = blob_keys
+    state = {key: st.session_state[key] for key in PERSISTED_KEYS}
+    state["images"] = [blob_keys[id(image)] for image in st.session_state.images]
+    data = encode_session_state(state)
+    digest = hashlib.md5(data).hexdigest()
+    if digest != st.session_state.persisted_digest:
+        store.save(st.session_state.session_id, data, state["images"])
+        st.session_state.persisted_digest = digest
+    persist_saved_recipes(store)
+
+def persist_saved_recipes(store):
+    """Write only the saved recipes added or removed since the last save"""
+    saved = st.session_state.saved_recipes
+    # Recipes are only appended, or removed by replacing the list, so the same
+    # list at the same length has nothing new to write
+    signature = (id(saved), len(saved))
+    persisted = st.session_state.persisted_recipes
+    if signature == persisted["signature"]:
+        return
+    known = set(persisted["ids"])
+    ids = [recipe["id"] for recipe in saved]
+    added = [
+        (recipe["id"], json.dumps(recipe, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        for recipe in saved if recipe["id"] not in known
+    ]
+    current = set(ids)
+    removed = [recipe_id for recipe_id in persisted["ids"] if recipe_id not in current]
+    if added:
+        store.add_recipes(st.session_state.session_id, added)
+    if removed:
+        store.delete_recipes(st.session_state.session_id, removed)
+    st.session_state.persisted_recipes = {"signature": signature, "ids": ids}
+
+def profiling_enabled():
+    return PROFILE_RERUNS or st.query_params.get("profile") == "1"
+
+@st.cache_resource
+def get_profiler_lock():
+    """Process-wide lock so only one run is profiled at a time.
+
+    Python allows a single active profiler per process from 3.12 on, so a
+    run that cannot take the lock simply goes unprofiled.
+    """
+    return threading.Lock()
+
+def start_profiler():
+    """Start profiling this run, or return None if another run is being profiled"""
+    lock = get_profiler_lock()
+    if not lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiling tool, such as a debugger, is already active
+        lock.release()
+        return None
+    return profiler
+
+def stop_profiler(profiler):
+    profiler.disable()
+    get_profiler_lock().release()
+
+def record_profile(profiler, elapsed):
+    """Keep a finished script run's profile in the session's ring buffer"""
+    profiler.create_stats()
+    if 'profiles' not in st.session_state:
+        st.session_state.profiles = deque(maxlen=PROFILE_HISTORY)
+    st.session_state.profiles.append({
+        "page": st.session_state.page,
+        "elapsed": elapsed,
+        "profiler": profiler,
+    })
+
+def show_profiling_panel():
+    """Sidebar summary of the profiled runs, with a .prof export for offline flamegraphs"""
+    profiles = st.session_state.get("profiles")
+    if not profiles:
+        return
+    merged = pstats.Stats(*[profile["profiler"] for profile in profiles])
+    rows = sorted(merged.stats.items(), key=lambda entry: entry[1][3], reverse=True)[:15]
+    with st.sidebar.expander("⏱️ Profiler", expanded=True):
+        last = profiles[-1]
+        st.caption(f"Last run ({last['page']}): {last['elapsed'] * 1000:.0f} ms. "
+                   f"{len(profiles)} runs kept, {sum(p['elapsed'] for p in profiles) * 1000:.0f} ms in total.")
+        st.dataframe([
+            {
+                "Function": f"{os.path.basename(filename)}:{line}({name})",
+                "Calls": calls,
+                "Own (ms)": round(own * 1000, 1),
+                "Cumulative (ms)": round(cumulative * 1000, 1),
+            }
+            for (filename, line, name), (_, calls, own, cumulative, _) in rows
+        ], hide_index=True)
+        st.download_button("Export profile (.prof)",
+                           data=marshal.dumps(merged.stats),
+                           file_name="chefs_fridge.prof",
+                           mime="application/octet-stream")
+
 # Initialize session state
 def init_session_state():
     if 'page' not in st.session_state:
@@ -530,6 +1943,30 @@ def init_session_state():
         st.session_state.viewing_recipe = None
     if 'edit_index' not in st.session_state:
         st.session_state.edit_index = None
+    if 'recipe_stats' not in st.session_state:
+        st.session_state.recipe_stats = None
+    if 'prefetch' not in st.session_state:
+        st.session_state.prefetch = None
+    if 'generation' not in st.session_state:
+        st.session_state.generation = None
+    if 'prefetch_pending' not in st.session_state:
+        st.session_state.prefetch_pending = None
+    if 'prefetch_stats' not in st.session_state:
+        st.session_state.prefetch_stats = new_prefetch_stats()
+    if 'image_jobs' not in st.session_state:
+        st.session_state.image_jobs = {}
+    if 'image_items' not in st.session_state:
+        st.session_state.image_items = {}
+    if 'jobs' not in st.session_state:
+        st.session_state.jobs = {}
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = None
+    if 'blob_keys' not in st.session_state:
+        st.session_state.blob_keys = {}
+    if 'persisted_digest' not in st.session_state:
+        st.session_state.persisted_digest = None
+    if 'persisted_recipes' not in st.session_state:
+        st.session_state.persisted_recipes = {"signature": None, "ids": []}
 
 def set_page(page_name):
     st.session_state.page = page_name
@@ -578,8 +2015,8 @@ def home_page():
         for recipe in st.session_state.saved_recipes:
             st.markdown(f"""
             <div class="card">
-                <h3>{recipe['title']}</h3>
-                <p>Cuisine: {recipe['cuisine']}</p>
+                <h3>{html.escape(recipe['title'])}</h3>
+                <p>Cuisine: {html.escape(recipe['cuisine'])}</p>
                 <div style="display: flex; justify-content: flex-end;">
                     <button onclick="alert('View Recipe')" style="background: var(--primary-color); color: white; border: none; border-radius: 4px; padding: 0.3rem 0.6rem; cursor: pointer;">View</button>
                 </div>
@@ -590,6 +2027,33 @@ def home_page():
                 st.session_state.page = "View Recipe"
                 st.rerun()
     
+    # Bulk backup and restore of saved recipes
+    with st.expander("📦 Backup & Restore"):
+        if st.session_state.saved_recipes:
+            recipes = list(st.session_state.saved_recipes)
+
+            def build_export():
+                # Only runs when the button is clicked, not on every rerun
+                buffer = io.BytesIO()
+                export_saved_recipes(recipes, buffer)
+                buffer.seek(0)
+                return buffer
+
+            st.download_button(f"Export {len(recipes)} saved recipes",
+                               data=build_export,
+                               file_name="saved_recipes.jsonl.gz",
+                               mime="application/gzip",
+                               use_container_width=True)
+        backup = st.file_uploader("Import recipes (.jsonl or .jsonl.gz)",
+                                  type=["jsonl", "gz"],
+                                  key="recipe_backup")
+        if backup and st.button("Import Recipes", use_container_width=True):
+            added, error = import_saved_recipes(backup, st.session_state.saved_recipes)
+            if error:
+                st.warning(f"Imported {added} recipes before the file turned out to be damaged ({error})")
+            else:
+                st.success(f"Imported {added} recipes")
+    
     # Add footer with author information
     st.markdown("""
     <div class="footer">
@@ -621,6 +2085,7 @@ def upload_images_page():
                 new_image = Image.open(uploaded_file)
                 if not is_duplicate(new_image, st.session_state.images):
                     st.session_state.images.append(new_image)
+                    queue_image_identification(new_image)
                     st.success(f"Added {uploaded_file.name}")
                 else:
                     st.info(f"Skipped duplicate image: {uploaded_file.name}")
@@ -631,6 +2096,7 @@ def upload_images_page():
             new_image = Image.open(camera_image)
             if not is_duplicate(new_image, st.session_state.images):
                 st.session_state.images.append(new_image)
+                queue_image_identification(new_image)
                 st.success("Photo added!")
             else:
                 st.info("This photo appears to be a duplicate")
@@ -644,7 +2110,7 @@ def upload_images_page():
                 st.image(img, use_container_width=True)
                 if st.button("❌", key=f"remove_{i}", 
                             help="Remove this photo"):
-                    st.session_state.images.pop(i)
+                    retract_image_identification(st.session_state.images.pop(i))
                     st.rerun()
 
         st.markdown("---")
@@ -687,13 +2153,37 @@ def identify_ingredients_page():
             st.rerun()
         return
 
+    # Results from photos still being identified in the background
+    if st.session_state.image_jobs:
+        st.info(f"🧠 Still scanning {len(st.session_state.image_jobs)} photo(s)... "
+                "new ingredients will appear below as they are found.")
+        poll_identification()
+    
     # Automatic detection on first load
-    if not st.session_state.ingredients and st.session_state.images:
+    elif not st.session_state.ingredients and st.session_state.images and "identify" not in st.session_state.jobs:
         if st.button("✨ Identify Ingredients", use_container_width=True):
+            if BACKGROUND_JOBS and GEMINI_API_KEY:
+                submit_job("identify", identify_job, [image.copy() for image in st.session_state.images])
+                st.rerun()
             with st.spinner("🧠 Scanning your photos for ingredients..."):
-                ingredients = identify_items(st.session_state.images)
+                images = st.session_state.images
+                ingredients = identify_items(images, tuple(image_hash(image) for image in images))
                 st.session_state.ingredients = [re.sub(r'^\s*[-•*]\s*', '', item) for item in ingredients]
 
+    # Operator comparison of identification modes
+    if OPERATOR_TOOLS:
+        with st.expander("⚙️ Compare identification modes"):
+            st.caption(f"Current mode: {IDENTIFY_MODE}")
+            if st.button("Run comparison", key="compare_identify_modes"):
+                if not GEMINI_API_KEY:
+                    st.error("Cannot compare modes: API key missing.")
+                else:
+                    with st.spinner("Running every identification mode..."):
+                        try:
+                            st.table(compare_identify_modes(st.session_state.images))
+                        except Exception as e:
+                            st.error(f"Error comparing modes: {str(e)}")
+
     # Manual add section
     with st.expander("➕ Add Ingredients", expanded=True):
         new_ing = st.text_input("Add ingredients (comma separated)",
@@ -744,6 +2234,13 @@ def identify_ingredients_page():
                         st.session_state.edit_mode[f"ingredient_{i}"] = False
                         st.rerun()
 
+    # Speculatively prefetch a recipe once no ingredient is being edited
+    # and the list has settled
+    if not any(st.session_state.edit_mode.values()):
+        start_recipe_prefetch(st.session_state.ingredients)
+        if st.session_state.prefetch_pending:
+            settle_prefetch()
+
     # Navigation footer
     st.markdown("---")
     cols = st.columns(2)
@@ -753,6 +2250,7 @@ def identify_ingredients_page():
             st.rerun()
     with cols[1]:
         if st.button("Create Recipes →", type="primary", use_container_width=True):
+            start_recipe_prefetch(st.session_state.ingredients, settled=True)
             st.session_state.page = "Generate Recipe"
             st.rerun()
     
@@ -803,20 +2301,62 @@ def generate_recipe_page():
     
     num_recipes = st.radio("Number of Recipes", [1, 2, 3], horizontal=True)
     
+    # A generation started for other preferences is no longer wanted
+    cancel_generation((diet_preference, cuisine_preference))
+    
+    # A prefetched recipe is only useful for the default preferences
+    if (diet_preference, cuisine_preference) == PREFETCH_PREFERENCES:
+        start_recipe_prefetch(st.session_state.ingredients)
+        if st.session_state.prefetch_pending:
+            settle_prefetch()
+    else:
+        discard_prefetch()
+        st.session_state.prefetch_pending = None
+    
     # Generate button
     if st.button("Generate Recipes", use_container_width=True):
+        if BACKGROUND_JOBS:
+            create_recipes(diet_preference, cuisine_preference, int(num_recipes), background=True)
+            st.rerun()
         with st.spinner("Creating your recipes..."):
-            st.session_state.recipes = generate_multiple_recipes(
-                st.session_state.ingredients, 
-                diet_preference, 
-                cuisine_preference, 
-                int(num_recipes)
-            )
+            create_recipes(diet_preference, cuisine_preference, int(num_recipes))
+    
+    # Operator view of speculative prefetch effectiveness
+    if OPERATOR_TOOLS and SPECULATIVE_PREFETCH:
+        metrics = st.session_state.prefetch_stats
+        with st.expander("⚙️ Prefetch stats"):
+            hit_rate = metrics["hits"] / metrics["started"] if metrics["started"] else 0
+            st.write(f"Hit rate: {hit_rate:.0%} ({metrics['hits']} of {metrics['started']} prefetches used)")
+            st.write(f"Discarded: {metrics['discarded']} "
+                     f"(wasted {metrics['wasted_requests']} requests, {metrics['wasted_tokens']} tokens)")
     
     # Display generated recipes
     if st.session_state.recipes:
         st.subheader("Your Recipes")
         
+        # Prompt token usage for the last generation
+        stats = st.session_state.recipe_stats
+        if stats and stats["requests"]:
+            usage = f"Prompt tokens per call: {stats['prompt_tokens'] // stats['requests']}"
+            if stats.get("dropped_items"):
+                usage += f" ({stats['dropped_items']} ingredients left out to fit the prompt budget)"
+            st.caption(usage)
+        if stats and stats.get("wasted_calls"):
+            st.caption(f"Replaced {stats['wasted_calls']} near-duplicate recipe(s); "
+                       f"{stats['saved_calls']} call(s) saved by not regenerating the whole batch")
+        
+        # Recipes served from similar past requests, with the option to generate new ones
+        if stats and stats.get("reused"):
+            st.info(f"♻️ {stats['reused']} recipe(s) reused from a similar set of ingredients.")
+            if st.button("Generate fresh recipes instead", use_container_width=True):
+                if BACKGROUND_JOBS:
+                    create_recipes(diet_preference, cuisine_preference, int(num_recipes), reuse=False,
+                                   background=True)
+                    st.rerun()
+                with st.spinner("Creating your recipes..."):
+                    create_recipes(diet_preference, cuisine_preference, int(num_recipes), reuse=False)
+                st.rerun()
+        
         for i, recipe in enumerate(st.session_state.recipes):
             # Clean recipe text
             recipe = clean_text(recipe)
@@ -851,47 +2391,33 @@ def generate_recipe_page():
                         st.success(f"Saved: {title}")
                 
                 with tabs[1]:
-                    # Extract ingredients
-                    ingredients = parse_recipe_ingredients(recipe)
+                    # Ingredients rendered as a single cached fragment
+                    ingredients_html = render_ingredients_html(recipe)
                     
-                    if ingredients:
-                        st.markdown("<div style='margin-top: 10px;'>", unsafe_allow_html=True)
-                        for ingredient in ingredients:
-                            # Clean any bullet points in the ingredient
-                            clean_ingredient = re.sub(r'^\s*[•\-*]\s+', '', ingredient)
-                            st.markdown(f"""
-                            <div class="ingredient-list-item">
-                                <span class="ingredient-bullet">•</span>
-                                <span>{clean_ingredient}</span>
-                            </div>
-                            """, unsafe_allow_html=True)
-                        st.markdown("</div>", unsafe_allow_html=True)
+                    if ingredients_html:
+                        st.markdown(ingredients_html, unsafe_allow_html=True)
                     else:
                         # Fallback
                         st.markdown(recipe.split("\n\n")[0] if "\n\n" in recipe else recipe)
                 
                 with tabs[2]:
-                    # Extract steps
-                    steps = parse_recipe_steps(recipe)
+                    # Steps rendered as a single cached fragment
+                    steps_html = render_steps_html(recipe)
                     
-                    if steps:
-                        st.markdown("<div style='margin-top: 10px;'>", unsafe_allow_html=True)
-                        for j, step in enumerate(steps, 1):
-                            # Ensure no bullet points in the step text
-                            clean_step = re.sub(r'^\s*[•\-*]\s+', '', step)
-                            st.markdown(f"""
-                            <div class="step-card">
-                                <span class="step-number">{j}</span>
-                                <span>{clean_step}</span>
-                            </div>
-                            """, unsafe_allow_html=True)
-                        st.markdown("</div>", unsafe_allow_html=True)
+                    if steps_html:
+                        st.markdown(steps_html, unsafe_allow_html=True)
                     else:
                         # Fallback
                         st.text(recipe)
         
         # Download PDF option
         st.markdown(get_pdf_download_link(st.session_state.recipes), unsafe_allow_html=True)
+        
+        # Operator comparison of PDF backends
+        if OPERATOR_TOOLS:
+            with st.expander("⚙️ PDF size benchmark"):
+                if st.button("Run benchmark", key="benchmark_pdf"):
+                    st.table(benchmark_pdf_backends(st.session_state.recipes))
     
     # Back button
     if st.button("Back to Ingredients", use_container_width=True):
@@ -911,7 +2437,7 @@ def view_saved_recipe():
     tabs = st.tabs(["Overview", "Ingredients", "Steps"])
     
     with tabs[0]:
-        st.markdown(f"<h3>{recipe['title']}</h3>", unsafe_allow_html=True)
+        st.markdown(f"<h3>{html.escape(recipe['title'])}</h3>", unsafe_allow_html=True)
         
         if recipe['diet'] != "None":
             st.markdown(f"**Diet:** {recipe['diet']}")
@@ -931,40 +2457,21 @@ def view_saved_recipe():
             st.rerun()
     
     with tabs[1]:
-        # Extract ingredients section
-        ingredients = parse_recipe_ingredients(recipe['content'])
+        # Ingredients rendered as a single cached fragment
+        ingredients_html = render_ingredients_html(recipe['content'])
         
-        if ingredients:
-            st.markdown("<div style='margin-top: 10px;'>", unsafe_allow_html=True)
-            for ingredient in ingredients:
-                # Clean any bullet points in the ingredient
-                clean_ingredient = re.sub(r'^\s*[•\-*]\s+', '', ingredient)
-                st.markdown(f"""
-                <div class="ingredient-list-item">
-                    <span class="ingredient-bullet">•</span>
-                    <span>{clean_ingredient}</span>
-                </div>
-                """, unsafe_allow_html=True)
-            st.markdown("</div>", unsafe_allow_html=True)
+        if ingredients_html:
+            st.markdown(ingredients_html, unsafe_allow_html=True)
         else:
             # Fallback to showing part of the recipe
             st.write(recipe['content'].split('\n\n')[0] if '\n\n' in recipe['content'] else recipe['content'])
     
     with tabs[2]:
-        steps = parse_recipe_steps(recipe['content'])
+        # Steps rendered as a single cached fragment
+        steps_html = render_steps_html(recipe['content'])
         
-        if steps:
-            st.markdown("<div style='margin-top: 10px;'>", unsafe_allow_html=True)
-            for idx, step in enumerate(steps, 1):
-                # Ensure no bullet points in the step text
-                clean_step = re.sub(r'^\s*[•\-*]\s+', '', step)
-                st.markdown(f"""
-                <div class="step-card">
-                    <span class="step-number">{idx}</span>
-                    <span>{clean_step}</span>
-                </div>
-                """, unsafe_allow_html=True)
-            st.markdown("</div>", unsafe_allow_html=True)
+        if steps_html:
+            st.markdown(steps_html, unsafe_allow_html=True)
         else:
             # Fallback
             st.write(recipe['content'])
@@ -977,11 +2484,41 @@ def view_saved_recipe():
 
 def main():
     init_session_state()
+    restore_session()
+    started = time.perf_counter()
+    profiler = start_profiler() if profiling_enabled() else None
+    try:
+        render_app()
+    finally:
+        if profiler:
+            stop_profiler(profiler)
+            record_profile(profiler, time.perf_counter() - started)
+        # Runs on st.rerun() too, so every change reaches the session store
+        persist_session()
+    if profiling_enabled():
+        show_profiling_panel()
+
+def render_app():
+    collect_identification_results()
+    collect_job_results()
+    
+    # A foreground generation is only wanted while the user stays on the Recipes page
+    if st.session_state.page != "Generate Recipe":
+        cancel_generation()
+    
+    # A prefetched recipe is only wanted while the user is heading to the Recipes page
+    if st.session_state.page not in ("Identify Ingredients", "Generate Recipe"):
+        discard_prefetch()
+        st.session_state.prefetch_pending = None
     
     # Display navigation
     if st.session_state.page != "Home":
         show_navigation()
     
+    # Background jobs keep running across reruns and page switches
+    if st.session_state.jobs:
+        show_job_status()
+    
     # Sidebar navigation
     with st.sidebar:
         st.title("Chef's Fridge")
@@ -999,6 +2536,13 @@ def main():
             st.session_state.page = "Generate Recipe"
             st.rerun()
         
+        # Hedging metrics for operators
+        if OPERATOR_TOOLS and HEDGE_REQUESTS:
+            state = get_hedge_state()
+            st.sidebar.markdown("---")
+            st.sidebar.caption(f"Hedges: {state['hedges_issued']} issued, {state['hedges_won']} won, "
+                               f"{state['calls']} calls")
+        
         # Saved recipes in sidebar
         if st.session_state.saved_recipes:
             st.sidebar.markdown("---")
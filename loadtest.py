@@ -0,0 +1,270 @@
+"""Concurrent-session load test for Chef's Fridge.
+
+Drives simulated sessions through the real page flow (home, upload,
+identify, generate) with Streamlit's app testing API, replacing the Gemini
+model with a local stand-in. For each concurrency level it reports rerun
+latency percentiles, throughput and memory per session, then estimates the
+knee of the scaling curve.
+
+    python loadtest.py --sessions 1,2,4,8,16 --model-latency 0.2
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# Numbers the photos so every simulated session uploads different ones and
+# identification is never answered from the app's cache
+photo_numbers = itertools.count()
+photo_numbers_lock = threading.Lock()
+
+STAND_IN_RECIPE = """Garden Omelette
+
+INGREDIENTS:
+3 eggs
+50 g cheese
+1 tomato, diced
+
+INSTRUCTIONS:
+1. Whisk the eggs with a pinch of salt.
+2. Cook in a buttered pan over medium heat.
+3. Add the cheese and tomato, fold and serve."""
+
+
+class StandInResponse:
+    def __init__(self, text, prompt_tokens, output_tokens):
+        self.text = text
+        self.usage_metadata = type("Usage", (), {
+            "prompt_token_count": prompt_tokens,
+            "candidates_token_count": output_tokens,
+        })()
+
+
+def install_stand_in_model(latency, jitter):
+    """Replace Gemini calls with a local stand-in that sleeps for a simulated latency"""
+    import google.generativeai as genai
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(max(0.0, random.uniform(latency - jitter, latency + jitter)))
+        prompt = contents if isinstance(contents, str) else contents[0]
+        images = 0 if isinstance(contents, str) else len(contents) - 1
+        if "numbered 1 to" in prompt:
+            text = "[" + ",".join(
+                f'{{"image": {i + 1}, "items": ["eggs", "cheese", "tomato"]}}' for i in range(images)
+            ) + "]"
+        elif images:
+            text = "eggs, cheese, tomato, milk"
+        else:
+            text = STAND_IN_RECIPE
+        return StandInResponse(text, 258 * images + len(prompt) // 4, len(text) // 4)
+
+    genai.GenerativeModel.generate_content = generate_content
+
+
+def prepare_concurrent_app_tests():
+    """Let AppTest runs from many threads share one mock runtime, as sessions share a server.
+
+    Each AppTest run installs its own mock runtime and removes it when the
+    run ends, which breaks other runs still in progress. The first runtime
+    installed is kept and handed to every run instead. Compiling the script
+    is also serialised, since concurrent ast.parse calls are not safe on
+    every Python version. AppTest also patches its config option in for the
+    length of each run, and a run that finishes can undo another's patch, so
+    the option is set for the whole process.
+    """
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import AppTest
+
+    config.set_option("global.appTest", True)
+
+    shared = {}
+    lock = threading.Lock()
+
+    def current(cls):
+        with lock:
+            if cls._instance is not None:
+                shared.setdefault("runtime", cls._instance)
+            return shared.get("runtime")
+
+    def instance(cls):
+        runtime = current(cls)
+        if runtime is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        return runtime
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: current(cls) is not None)
+
+    # Component discovery scans every installed package, so it is done once
+    # rather than on each simulated session's first run
+    original_run = AppTest._run
+
+    def run(self, *args, **kwargs):
+        if getattr(self, "_bidi_component_manager", False) is None and "components" in shared:
+            self._bidi_component_manager = shared["components"]
+        result = original_run(self, *args, **kwargs)
+        shared.setdefault("components", getattr(self, "_bidi_component_manager", None))
+        return result
+
+    AppTest._run = run
+
+    compile_lock = threading.Lock()
+    original_get_bytecode = ScriptCache.get_bytecode
+
+    def get_bytecode(self, script_path):
+        with compile_lock:
+            return original_get_bytecode(self, script_path)
+
+    ScriptCache.get_bytecode = get_bytecode
+
+
+def click(app, label, timeout):
+    """Click the button with the given label and time the resulting rerun"""
+    button = next((button for button in app.button if button.label == label), None)
+    if button is None:
+        raise RuntimeError(f"Button {label!r} not found on the {app.session_state['page']} page")
+    started = time.perf_counter()
+    button.click().run(timeout=timeout)
+    return time.perf_counter() - started
+
+
+def session_photos(count):
+    """Solid-colour photos that no other simulated session uses"""
+    photos = []
+    for _ in range(count):
+        with photo_numbers_lock:
+            number = next(photo_numbers)
+        photos.append(Image.new("RGB", (1280, 960), (number % 256, number // 256 % 256, 80)))
+    return photos
+
+
+def run_session(photo_count, timeout):
+    """Drive one session through the page flow, returning (app, rerun latencies)"""
+    from streamlit.testing.v1 import AppTest
+
+    images = session_photos(photo_count)
+    latencies = []
+    app = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    started = time.perf_counter()
+    app.run()
+    latencies.append(time.perf_counter() - started)
+    latencies.append(click(app, "Get Started", timeout))
+    # File uploads cannot be simulated, so photos are placed in session state
+    app.session_state["images"] = images
+    started = time.perf_counter()
+    app.run()
+    latencies.append(time.perf_counter() - started)
+    latencies.append(click(app, "Continue to Ingredients →", timeout))
+    latencies.append(click(app, "✨ Identify Ingredients", timeout))
+    latencies.append(click(app, "Create Recipes →", timeout))
+    latencies.append(click(app, "Generate Recipes", timeout))
+    if app.exception:
+        raise RuntimeError(app.exception[0].message)
+    return app, latencies
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def run_sessions(sessions, photo_count, timeout):
+    """Run concurrent sessions to completion, returning their results"""
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        return list(pool.map(lambda _: run_session(photo_count, timeout), range(sessions)))
+
+
+def measure_memory(sessions, photo_count, timeout):
+    """Traced memory held per session, from a separate untimed pass"""
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    results = run_sessions(sessions, photo_count, timeout)
+    # Apps are still referenced here, so their session state counts towards memory
+    memory = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    del results
+    return memory / sessions
+
+
+def run_level(sessions, photo_count, timeout):
+    """Run a number of concurrent sessions and summarise the results.
+
+    Tracing allocations slows every rerun down, so latency and throughput
+    come from an untraced pass and memory from a second, traced one.
+    """
+    started = time.perf_counter()
+    results = run_sessions(sessions, photo_count, timeout)
+    elapsed = time.perf_counter() - started
+    latencies = [latency for _, session_latencies in results for latency in session_latencies]
+    del results
+    return {
+        "sessions": sessions,
+        "reruns": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": statistics.mean(latencies),
+        "memory_per_session": measure_memory(sessions, photo_count, timeout),
+    }
+
+
+def find_knee(rows, min_gain):
+    """First level after which adding sessions no longer raises throughput enough"""
+    for previous, current in zip(rows, rows[1:]):
+        added = current["sessions"] - previous["sessions"]
+        per_session = rows[0]["throughput"] / rows[0]["sessions"]
+        if (current["throughput"] - previous["throughput"]) / added < min_gain * per_session:
+            return previous["sessions"]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", default="1,2,4,8,16",
+                        help="comma-separated concurrent session counts")
+    parser.add_argument("--images", type=int, default=2, help="photos uploaded per session")
+    parser.add_argument("--model-latency", type=float, default=0.2,
+                        help="mean stand-in model latency in seconds")
+    parser.add_argument("--model-jitter", type=float, default=0.05,
+                        help="stand-in model latency jitter in seconds")
+    parser.add_argument("--timeout", type=float, default=120, help="per-rerun timeout in seconds")
+    parser.add_argument("--min-gain", type=float, default=0.1,
+                        help="knee threshold, as a fraction of single-session throughput per added session")
+    args = parser.parse_args()
+
+    os.environ.setdefault("GEMINI_API_KEY", "load-test")
+    install_stand_in_model(args.model_latency, args.model_jitter)
+    prepare_concurrent_app_tests()
+    # One untimed session first, so one-off import costs are not counted
+    run_session(args.images, args.timeout)
+
+    rows = []
+    print(f"{'sessions':>8} {'reruns':>7} {'rerun/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'KB/session':>11}")
+    for sessions in [int(count) for count in args.sessions.split(",")]:
+        row = run_level(sessions, args.images, args.timeout)
+        rows.append(row)
+        print(f"{row['sessions']:>8} {row['reruns']:>7} {row['throughput']:>8.1f} "
+              f"{row['p50'] * 1000:>8.0f} {row['p95'] * 1000:>8.0f} {row['p99'] * 1000:>8.0f} "
+              f"{row['memory_per_session'] / 1024:>11.0f}")
+
+    knee = find_knee(rows, args.min_gain)
+    if knee is None:
+        print("No knee found: throughput was still scaling at the highest session count.")
+    else:
+        print(f"Knee at about {knee} concurrent sessions.")
+
+
+if __name__ == "__main__":
+    main()